@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate: float = rate
+        self.burst: float = burst
+        self._tokens: float = burst
+        self._last: float = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last) * self.rate
+        )
+        self._last = now
+
+    def peek(self, tokens: float = 1) -> bool:
+        self._refill()
+        return self._tokens >= tokens
+
+    def consume(self, tokens: float = 1) -> bool:
+        if not self.peek(tokens):
+            return False
+        self._tokens -= tokens
+        return True
+
+
+class DispatchQueues:
+    def __init__(self, limits: Dict[Optional[int], int]):
+        # priority -> maximum queue size, None is the default for every
+        # priority that is not listed, 0 means unbounded
+        self._limits: Dict[Optional[int], int] = limits
+        self._queues: Dict[int, Deque[Any]] = {}
+        self._lock = threading.Lock()
+        self._conds: Dict[int, threading.Condition] = {}
+        self._closed: bool = False
+
+    def _cond(self, priority: int) -> threading.Condition:
+        cond = self._conds.get(priority)
+        if cond is None:
+            cond = self._conds[priority] = threading.Condition(self._lock)
+            self._queues[priority] = deque()
+        return cond
+
+    def put(self, priority: int, item: Any) -> bool:
+        limit = self._limits.get(priority, self._limits.get(None, 0))
+        with self._lock:
+            cond = self._cond(priority)
+            queue = self._queues[priority]
+            if limit and len(queue) >= limit:
+                return False
+            queue.append(item)
+            cond.notify()
+        return True
+
+    def get(self, priority: int) -> Optional[Any]:
+        """Blocks until an item of `priority` is available and returns
+        it.  Returns `None` once the queues are closed.
+        """
+        with self._lock:
+            cond = self._cond(priority)
+            queue = self._queues[priority]
+            while True:
+                if self._closed:
+                    return None
+                if queue:
+                    return queue.popleft()
+                cond.wait()
+
+    def qsize(self, priority: int) -> int:
+        with self._lock:
+            queue = self._queues.get(priority)
+            return len(queue) if queue else 0
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for cond in self._conds.values():
+                cond.notify_all()
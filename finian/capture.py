@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import BinaryIO, Iterator, Optional
+
+RECV = 0
+SEND = 1
+
+# magic, version, wall clock time of the first frame
+_FILE_HEADER = struct.Struct("<4sHd")
+# time offset, connection, direction, is json, protocol, data size
+_FRAME_HEADER = struct.Struct("<dIB?HI")
+_MAGIC = b"FNCP"
+_VERSION = 2
+
+
+class Frame:
+    # time offset, connection, direction, is json, protocol, data
+    def __init__(self, offset: float, conn_id: int, direction: int,
+                 is_json: bool, protocol: int, data: bytes):
+        self.offset: float = offset
+        self.conn_id: int = conn_id
+        self.direction: int = direction
+        self.json: bool = is_json
+        self.protocol: int = protocol
+        self.data: bytes = data
+
+
+class CaptureWriter:
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path: str = path
+        # buffered frames are written out at least this often, so a
+        # capture of a running server can be read and survives a crash
+        # up to the last flush
+        self.flush_interval: float = flush_interval
+        self._file: BinaryIO = open(path, "wb")
+        self._lock = threading.Lock()
+        self._start: float = time.monotonic()
+        self._last_flush: float = self._start
+        self._next_conn_id: int = 0
+        self._file.write(_FILE_HEADER.pack(_MAGIC, _VERSION, time.time()))
+        self._file.flush()
+
+    def new_conn_id(self) -> int:
+        with self._lock:
+            conn_id = self._next_conn_id
+            self._next_conn_id += 1
+        return conn_id
+
+    def record(self, conn_id: int, direction: int, is_json: bool,
+               protocol: int, data: Optional[bytes]):
+        if data is None:
+            data = b""
+        offset = time.monotonic() - self._start
+        with self._lock:
+            # closing is how a running capture is stopped, connections
+            # still holding the writer just stop recording
+            if self._file.closed:
+                return
+            self._file.write(_FRAME_HEADER.pack(
+                offset, conn_id, direction, is_json, protocol, len(data)
+            ))
+            self._file.write(data)
+            if offset + self._start - self._last_flush \
+                    >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        self._file.flush()
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+
+class CaptureReader:
+    def __init__(self, path: str):
+        self.path: str = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _FILE_HEADER.size:
+                raise ValueError(f"{path} is not a finian capture file")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.started = \
+            _FILE_HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or version != _VERSION:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a finian capture file")
+
+    def __iter__(self) -> Iterator[Frame]:
+        pos = _FILE_HEADER.size
+        end = len(self._mmap)
+        while pos + _FRAME_HEADER.size <= end:
+            offset, conn_id, direction, is_json, protocol, size = \
+                _FRAME_HEADER.unpack_from(self._mmap, pos)
+            pos += _FRAME_HEADER.size
+            if pos + size > end:
+                # the writer was interrupted in the middle of a frame
+                break
+            yield Frame(offset, conn_id, direction, is_json, protocol,
+                        self._mmap[pos:pos + size])
+            pos += size
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
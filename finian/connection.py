@@ -3,17 +3,28 @@
 import json
 import sys
 import threading
-from typing import Any, Callable, Dict, Optional
+import time
+from typing import Any, Callable, Dict, Optional, Set, Tuple
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+from .admission import DispatchQueues, TokenBucket
+from .capture import CaptureWriter, RECV, SEND
 from .ctx import ConnContext
 from .tcpsocket import Result, TCPSocket, DataType
 
 _sentinel = object()
 
+# Sent back in place of a frame that was dropped by admission control.
+REJECT_PROTOCOL = 0xFFFF
+# Handled inline by the listening thread rather than queued.
+_CONTROL_PROTOCOLS = (1, 2, REJECT_PROTOCOL)
+# The first frame of each of these skips admission control so that the
+# key exchange always goes through, repeats are rate limited as usual.
+_HANDSHAKE_PROTOCOLS = (1, 2)
+
 RecvCallbackType = Callable[["Connection", Result], None]
 ConnectionBrokeCallbackType = Callable[["Connection"], None]
 
@@ -28,6 +39,11 @@ def protocol_recv_pubkey(connection: "Connection", result: Result):
     connection.recp_pubkey = result.data
 
 
+# Protocol 0xFFFF
+def protocol_rejected(connection: "Connection", result: Result):
+    connection._rejected_callback(connection, result)
+
+
 class Connection:
     def __init__(self, socket: TCPSocket = None):
         if socket is None:
@@ -35,12 +51,33 @@ class Connection:
         self.socket: TCPSocket = socket
         self.session: Dict[str, Any] = {}
         self._recv_callbacks: Dict[int, RecvCallbackType] = {}
+        self._raw_callbacks: Dict[int, RecvCallbackType] = {}
         self._recv_no_protocol_callback: RecvCallbackType = lambda c, r: None
         self._connection_broke_callback: ConnectionBrokeCallbackType = \
             lambda c: None
+        self._rejected_callback: RecvCallbackType = lambda c, r: None
+        self._priorities: Dict[int, int] = {}
+        self._rate_limits: Dict[Optional[int], Tuple[float, float]] = {}
+        self._queue_limits: Dict[Optional[int], int] = {}
+        self._dispatch_workers: Dict[Optional[int], int] = {}
+        self._buckets: Dict[Optional[int], TokenBucket] = {}
+        self._handshake_seen: Set[int] = set()
+        # at most one reject frame per protocol is sent in this many
+        # seconds, frames dropped in between are only counted
+        self.reject_interval: float = 1.0
+        # protocol -> when its last reject frame was sent
+        self._reject_sent: Dict[int, float] = {}
+        # protocol -> frames dropped since then and the latest reason, only
+        # while a count is waiting to be sent
+        self._rejects: Dict[int, Tuple[int, str]] = {}
+        self._rejects_lock = threading.Lock()
+        self._reject_timer: Optional[threading.Timer] = None
         self._pubkey: Optional[rsa.RSAPublicKey] = None
+        self._capture: Optional[CaptureWriter] = None
+        self._capture_id: int = 0
         self.protocol(1, False)(protocol_request_pubkey)
         self.protocol(2, False)(protocol_recv_pubkey)
+        self.protocol(REJECT_PROTOCOL, False)(protocol_rejected)
         self.teardown_conn_context_funcs = []
 
     def teardown_conn_context(self, f):
@@ -91,10 +128,23 @@ class Connection:
     def recp_pubkey(self, value):
         self.socket.recp_pubkey = value
 
+    @property
+    def capture(self):
+        return self._capture
+
+    @capture.setter
+    def capture(self, value: Optional[CaptureWriter]):
+        # every connection sharing a writer gets its own id so that the
+        # frames can be told apart again on replay
+        if value is not None:
+            self._capture_id = value.new_conn_id()
+        self._capture = value
+
     def disconnect(self):
         self.socket.disconnect()
 
-    def protocol(self, protocol: int, threaded: bool = True):
+    def protocol(self, protocol: int, threaded: bool = True,
+                 priority: int = 0):
         def decorator(callback: RecvCallbackType):
             def threaded_callback(*args):
                 thread = threading.Thread(target=callback, args=args)
@@ -103,16 +153,56 @@ class Connection:
 
             self._recv_callbacks[protocol] = \
                 threaded_callback if threaded else callback
+            # queued frames run on the dispatch workers, which call the
+            # handler as registered instead of starting a thread for it
+            self._raw_callbacks[protocol] = callback
+            if priority:
+                self._priorities[protocol] = priority
+            else:
+                self._priorities.pop(protocol, None)
 
         return decorator
 
+    def rate_limit(self, rate: float, burst: float = None,
+                   protocol: int = None):
+        """Admits at most `rate` frames per second with bursts of up to
+        `burst` frames, either for the whole connection or, when
+        `protocol` is given, for that protocol alone.  Frames over the
+        limit are dropped and answered with a reject frame.
+        """
+        if burst is None:
+            burst = max(rate, 1)
+        self._rate_limits[protocol] = (rate, burst)
+
+    def queue_limit(self, size: int, priority: int = None):
+        """Caps the dispatch queue of `priority`, or of every priority
+        without its own cap when `priority` is `None`.  Frames arriving at
+        a full queue are dropped and answered with a reject frame.
+        """
+        self._queue_limits[priority] = size
+
+    def dispatch_workers(self, count: int, priority: int = None):
+        """Sets how many handlers of `priority`, or of every priority
+        without its own setting when `priority` is `None`, run at the
+        same time.  Defaults to one.
+        """
+        self._dispatch_workers[priority] = count
+
     def connection_broke(self, callback: ConnectionBrokeCallbackType):
         self._connection_broke_callback = callback
 
+    def rejected(self, callback: RecvCallbackType):
+        self._rejected_callback = callback
+
     def recv(self) -> Optional[Result]:
         result = self.socket.recv()
         if result is None:
             return None
+        if self.capture is not None and not result.encrypted:
+            self.capture.record(
+                self._capture_id, RECV, result.json, result.protocol,
+                result.data
+            )
         if not result.encrypted and result.json:
             result.data = json.loads(result.data.decode())
         return result
@@ -122,27 +212,166 @@ class Connection:
         if isinstance(data, dict):
             data = json.dumps(data).encode()
             is_json = True
+        if self.capture is not None:
+            self.capture.record(
+                self._capture_id, SEND, is_json, protocol, data
+            )
         try:
             self.socket.send(data, is_json, protocol)
         except (BrokenPipeError, TimeoutError):
             self._connection_broke_callback(self)
 
-    def listen(self):
+    def _admit(self, protocol: int) -> bool:
+        buckets = []
+        for key in (protocol, None):
+            if key not in self._rate_limits:
+                continue
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(*self._rate_limits[key])
+                self._buckets[key] = bucket
+            buckets.append(bucket)
+        # only charge the buckets once all of them admit the frame, so a
+        # protocol over its own limit does not use up the connection's
+        if not all(bucket.peek() for bucket in buckets):
+            return False
+        for bucket in buckets:
+            bucket.consume()
+        return True
+
+    def _reject(self, protocol: int, reason: str):
+        with self._rejects_lock:
+            now = time.monotonic()
+            dropped = self._rejects.pop(protocol, (0, reason))[0] + 1
+            last = self._reject_sent.get(protocol)
+            if last is not None and now - last < self.reject_interval:
+                # held back, the timer reports it once the interval is up
+                self._rejects[protocol] = (dropped, reason)
+                if self._reject_timer is None:
+                    self._arm_reject_timer(last + self.reject_interval - now)
+                return
+            self._reject_sent[protocol] = now
+        self._send_reject(protocol, reason, dropped)
+
+    def _arm_reject_timer(self, delay: float):
+        self._reject_timer = threading.Timer(delay, self._flush_rejects)
+        self._reject_timer.daemon = True
+        self._reject_timer.start()
+
+    def _send_reject(self, protocol: int, reason: str, dropped: int,
+                     closing: bool = False):
+        # dropped counts every frame dropped since the previous reject
+        # frame for the protocol
+        data = {"protocol": protocol, "reason": reason, "dropped": dropped}
+        if not closing:
+            self.send(data, REJECT_PROTOCOL)
+            return
+        # the connection is going away, a failed send must not report the
+        # broken connection a second time
+        try:
+            self.socket.send(json.dumps(data).encode(), True, REJECT_PROTOCOL)
+        except OSError:
+            pass
+
+    def _flush_rejects(self, closing: bool = False):
+        due = []
+        with self._rejects_lock:
+            self._reject_timer = None
+            now = time.monotonic()
+            next_due = None
+            for protocol, (dropped, reason) in list(self._rejects.items()):
+                last = self._reject_sent[protocol]
+                if closing or now - last >= self.reject_interval:
+                    del self._rejects[protocol]
+                    self._reject_sent[protocol] = now
+                    due.append((protocol, reason, dropped))
+                elif next_due is None or last < next_due:
+                    next_due = last
+            if next_due is not None and not closing:
+                self._arm_reject_timer(next_due + self.reject_interval - now)
+        for protocol, reason, dropped in due:
+            self._send_reject(protocol, reason, dropped, closing)
+
+    def _dispatch(self, result: Result):
+        if result.protocol in self._recv_callbacks:
+            callback = self._recv_callbacks[result.protocol]
+        else:
+            callback = self._recv_no_protocol_callback
+        callback(self, result)
+
+    def _dispatch_queued(self, queues: DispatchQueues, priority: int):
         while True:
-            try:
-                result = self.recv()
-                if result is None:
-                    raise ConnectionResetError("Connection broke")
-            except (ConnectionResetError, TimeoutError):
-                self._connection_broke_callback(self)
+            result = queues.get(priority)
+            if result is None:
                 break
-            if result.protocol == 0:
-                continue
-            if result.protocol in self._recv_callbacks:
-                callback = self._recv_callbacks[result.protocol]
+            # run the handler itself rather than its thread starting
+            # wrapper, so that the queue only drains as fast as the workers
+            # get through the frames
+            if result.protocol in self._raw_callbacks:
+                callback = self._raw_callbacks[result.protocol]
             else:
                 callback = self._recv_no_protocol_callback
             callback(self, result)
 
+    def _start_dispatch_workers(self, queues: DispatchQueues,
+                                priority: int):
+        count = self._dispatch_workers.get(
+            priority, self._dispatch_workers.get(None, 1)
+        )
+        for _ in range(count):
+            thread = threading.Thread(
+                target=self._dispatch_queued, args=(queues, priority)
+            )
+            thread.daemon = True
+            thread.start()
+
+    def listen(self):
+        # Frames only go through priority queues once priorities, queue
+        # limits or worker counts are configured, otherwise they are
+        # dispatched inline.  Every priority then has its own queue and
+        # its own workers, which run the handlers whether they were
+        # registered as threaded or not.
+        queues = None
+        started = set()
+        if self._priorities or self._queue_limits or self._dispatch_workers:
+            queues = DispatchQueues(self._queue_limits)
+        try:
+            while True:
+                try:
+                    result = self.recv()
+                    if result is None:
+                        raise ConnectionResetError("Connection broke")
+                except (ConnectionResetError, TimeoutError):
+                    self._connection_broke_callback(self)
+                    break
+                if result.protocol == 0:
+                    continue
+                if result.protocol in _HANDSHAKE_PROTOCOLS \
+                        and result.protocol not in self._handshake_seen:
+                    self._handshake_seen.add(result.protocol)
+                elif not self._admit(result.protocol):
+                    # answering a reject frame with another one could
+                    # bounce between two peers forever
+                    if result.protocol != REJECT_PROTOCOL:
+                        self._reject(result.protocol, "rate_limited")
+                    continue
+                if queues is not None \
+                        and result.protocol not in _CONTROL_PROTOCOLS:
+                    priority = self._priorities.get(result.protocol, 0)
+                    if priority not in started:
+                        self._start_dispatch_workers(queues, priority)
+                        started.add(priority)
+                    if not queues.put(priority, result):
+                        self._reject(result.protocol, "overloaded")
+                    continue
+                self._dispatch(result)
+        finally:
+            if queues is not None:
+                queues.close()
+            with self._rejects_lock:
+                if self._reject_timer is not None:
+                    self._reject_timer.cancel()
+            self._flush_rejects(closing=True)
+
     def request_recv_pubkey(self):
         self.socket.send(None, False, 1)
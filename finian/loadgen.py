@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import multiprocessing
+import socket
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .capture import CaptureReader, Frame, RECV, SEND
+from .client import Client
+from .connection import REJECT_PROTOCOL
+from .tcpsocket import Result
+
+# Protocols 1 and 2 exchange public keys, replaying the captured keys would
+# leave the server encrypting to a key the simulated client does not own,
+# clients do a key exchange of their own instead.  Reject frames are the
+# server's answer to load and not part of it.
+_SKIPPED_PROTOCOLS = (1, 2, REJECT_PROTOCOL)
+_DIRECTIONS = {"send": SEND, "recv": RECV}
+# how long a client waits for outstanding replies once the replay is done
+_DRAIN_TIMEOUT = 2.0
+# how long a client waits for the server's public key
+_KEY_EXCHANGE_TIMEOUT = 5.0
+
+
+def load_frames(path: str, direction: int) -> List[List[Frame]]:
+    """Returns the replayable frames of every captured connection, one
+    list per connection in the order the connections were captured.
+    """
+    conns: Dict[int, List[Frame]] = {}
+    with CaptureReader(path) as reader:
+        for frame in reader:
+            if frame.direction == direction \
+                    and frame.protocol not in _SKIPPED_PROTOCOLS:
+                conns.setdefault(frame.conn_id, []).append(frame)
+    return [conns[conn_id] for conn_id in sorted(conns)]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    index = round(pct / 100 * (len(values) - 1))
+    return values[index]
+
+
+class _ReplayStats:
+    def __init__(self):
+        self.sent: int = 0
+        self.received: int = 0
+        self.rejected: int = 0
+        self.bytes_sent: int = 0
+        self.failed: int = 0
+        self.errors: int = 0
+        # monotonic time of the first and last send, the clock is shared
+        # between processes so the windows of all workers can be merged
+        self.first_send: Optional[float] = None
+        self.last_send: Optional[float] = None
+        self.drain: float = 0.0
+        self.send_latencies: List[float] = []
+        self.reply_latencies: List[float] = []
+
+    def merge(self, other: "_ReplayStats"):
+        self.sent += other.sent
+        self.received += other.received
+        self.rejected += other.rejected
+        self.bytes_sent += other.bytes_sent
+        self.failed += other.failed
+        self.errors += other.errors
+        if other.first_send is not None:
+            if self.first_send is None or other.first_send < self.first_send:
+                self.first_send = other.first_send
+            if self.last_send is None or other.last_send > self.last_send:
+                self.last_send = other.last_send
+        self.drain = max(self.drain, other.drain)
+        self.send_latencies.extend(other.send_latencies)
+        self.reply_latencies.extend(other.reply_latencies)
+
+
+def _key_exchange(client: Client) -> bool:
+    key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend()
+    )
+    client.privkey = key
+    client.pubkey = key.public_key()
+    # A public key is too large to be encrypted with RSA-OAEP, so neither
+    # side may hold the other's key before sending its own.  The server
+    # answers the request before it reads our key, and ours goes out
+    # before the server's is put in place.
+    received = []
+    client.protocol(2, False)(lambda c, r: received.append(r.data))
+    client.request_recv_pubkey()
+    client.send(client.pubkey, 2)
+    deadline = time.monotonic() + _KEY_EXCHANGE_TIMEOUT
+    while not received:
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    if received[0] is None:
+        # the server has no key pair of its own
+        return False
+    client.recp_pubkey = received[0]
+    return True
+
+
+def _replay_client(host: str, port: int, frames: List[Frame], base: float,
+                   speed: float, replies: bool, key_exchange: bool,
+                   stats: _ReplayStats):
+    client = Client(host, port)
+    if not client.connect():
+        stats.failed += 1
+        return
+    broke = threading.Event()
+    pending: Deque[float] = deque()
+
+    def on_reply(_, __: Result):
+        now = time.monotonic()
+        stats.received += 1
+        if replies and pending:
+            stats.reply_latencies.append(now - pending.popleft())
+
+    def on_rejected(_, result: Result):
+        dropped = 1
+        if isinstance(result.data, dict):
+            dropped = result.data.get("dropped", 1)
+        stats.rejected += dropped
+        # a rejected frame will never be answered
+        for _ in range(dropped):
+            if not (replies and pending):
+                break
+            pending.popleft()
+
+    client._recv_no_protocol_callback = on_reply
+    client.rejected(on_rejected)
+    client.connection_broke(lambda c: broke.set())
+    listener = threading.Thread(target=client.listen)
+    listener.daemon = True
+    listener.start()
+
+    if key_exchange and not _key_exchange(client):
+        stats.failed += 1
+        frames = []
+
+    # every client shares the capture's time base so that the captured
+    # connections keep their relative timing
+    start = time.monotonic()
+    for frame in frames:
+        if broke.is_set():
+            break
+        scheduled = start + (frame.offset - base) / speed
+        delay = scheduled - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        data = json.loads(frame.data.decode()) if frame.json else frame.data
+        now = time.monotonic()
+        if stats.first_send is None:
+            stats.first_send = now
+        if replies:
+            pending.append(now)
+        try:
+            client.send(data, frame.protocol)
+        except ValueError:
+            # RSA-OAEP cannot encrypt frames larger than the key allows
+            stats.errors += 1
+            if replies:
+                pending.pop()
+            continue
+        stats.last_send = time.monotonic()
+        # measured from the scheduled time so that falling behind the
+        # capture shows up as latency instead of being hidden
+        stats.send_latencies.append(stats.last_send - scheduled)
+        stats.sent += 1
+        stats.bytes_sent += len(frame.data)
+    drain_start = time.monotonic()
+    deadline = drain_start + _DRAIN_TIMEOUT
+    while replies and pending and not broke.is_set() \
+            and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats.drain = time.monotonic() - drain_start
+    # shut down first so the listener sees the connection end cleanly
+    # before the socket is closed under it
+    try:
+        client.socket.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    listener.join(1)
+    client.socket.socket.close()
+
+
+def _replay_worker(
+        args: Tuple[str, int, str, int, float, List[int], bool, bool]) \
+        -> _ReplayStats:
+    host, port, path, direction, speed, clients, replies, key_exchange = \
+        args
+    conns = load_frames(path, direction)
+    base = min(frames[0].offset for frames in conns)
+    results = [_ReplayStats() for _ in clients]
+    threads = []
+    for client, stats in zip(clients, results):
+        # clients beyond the number of captured connections replay them
+        # again from the start
+        thread = threading.Thread(
+            target=_replay_client,
+            args=(host, port, conns[client % len(conns)], base, speed,
+                  replies, key_exchange, stats)
+        )
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    total = _ReplayStats()
+    for stats in results:
+        total.merge(stats)
+    return total
+
+
+def replay(host: str, port: int, path: str, direction: int = SEND,
+           speed: float = 1.0, clients: int = None, processes: int = 1,
+           replies: bool = False,
+           key_exchange: bool = False) -> Dict[str, float]:
+    """Replays every captured connection from its own client.  With
+    `clients` set, client `i` replays captured connection `i` modulo the
+    number of captured connections.  With `key_exchange` every client
+    exchanges public keys with the server first, so that the frames are
+    encrypted as in production.
+    """
+    conns = len(load_frames(path, direction))
+    if conns == 0:
+        raise ValueError(f"{path} has no frames to replay")
+    if clients is None:
+        clients = conns
+    processes = min(processes, clients)
+    # spread the simulated clients round robin over the processes
+    jobs = [(host, port, path, direction, speed,
+             list(range(i, clients, processes)), replies, key_exchange)
+            for i in range(processes)]
+    with multiprocessing.Pool(len(jobs)) as pool:
+        results = pool.map(_replay_worker, jobs)
+    total = _ReplayStats()
+    for stats in results:
+        total.merge(stats)
+    # throughput covers the sends only, not process startup, connecting
+    # or waiting for the last replies
+    elapsed = 0.0
+    if total.first_send is not None:
+        elapsed = total.last_send - total.first_send
+    total.send_latencies.sort()
+    total.reply_latencies.sort()
+    report = {
+        "clients": clients,
+        "failed": total.failed,
+        "errors": total.errors,
+        "elapsed": elapsed,
+        "drain": total.drain,
+        "sent": total.sent,
+        "received": total.received,
+        "rejected": total.rejected,
+        "frames_per_sec": total.sent / elapsed if elapsed else 0.0,
+        "bytes_per_sec": total.bytes_sent / elapsed if elapsed else 0.0,
+    }
+    for pct in (50, 90, 99):
+        report[f"send_p{pct}"] = percentile(total.send_latencies, pct)
+        if replies:
+            report[f"reply_p{pct}"] = \
+                percentile(total.reply_latencies, pct)
+    return report
+
+
+def info(path: str) -> Dict[str, float]:
+    frames = 0
+    size = 0
+    duration = 0.0
+    protocols: Dict[int, int] = {}
+    conns = set()
+    with CaptureReader(path) as reader:
+        for frame in reader:
+            frames += 1
+            conns.add(frame.conn_id)
+            size += len(frame.data)
+            duration = frame.offset
+            protocols[frame.protocol] = protocols.get(frame.protocol, 0) + 1
+    return {
+        "connections": len(conns),
+        "frames": frames,
+        "bytes": size,
+        "duration": duration,
+        "protocols": protocols,
+    }
+
+
+def _print_report(report):
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f"{value:.6f}"
+        print(f"{key:>16}: {value}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m finian.loadgen",
+        description="Replay finian capture files against a server."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    info_parser = commands.add_parser("info", help="summarize a capture")
+    info_parser.add_argument("capture")
+
+    replay_parser = commands.add_parser("replay", help="replay a capture")
+    replay_parser.add_argument("capture")
+    replay_parser.add_argument("host")
+    replay_parser.add_argument("port", type=int)
+    replay_parser.add_argument(
+        "--direction", choices=_DIRECTIONS, default="send",
+        help="replay frames the capturing side sent (client captures) or "
+             "received (server captures)"
+    )
+    replay_parser.add_argument("--speed", type=float, default=1.0,
+                               help="replay speed multiplier")
+    replay_parser.add_argument(
+        "--clients", type=int,
+        help="number of simulated clients, defaults to one per captured "
+             "connection"
+    )
+    replay_parser.add_argument("--processes", type=int, default=1,
+                               help="number of worker processes")
+    replay_parser.add_argument(
+        "--replies", action="store_true",
+        help="pair each received frame with the oldest unanswered send "
+             "and report reply latency"
+    )
+    replay_parser.add_argument(
+        "--key-exchange", action="store_true",
+        help="exchange public keys with the server before replaying so "
+             "that every frame is encrypted"
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "info":
+        try:
+            _print_report(info(args.capture))
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        return
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+    if args.clients is not None and args.clients < 1 \
+            or args.processes < 1:
+        parser.error("--clients and --processes must be at least 1")
+    try:
+        report = replay(
+            args.host, args.port, args.capture, _DIRECTIONS[args.direction],
+            args.speed, args.clients, args.processes, args.replies,
+            args.key_exchange
+        )
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    _print_report(report)
+
+
+if __name__ == "__main__":
+    main()
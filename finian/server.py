@@ -23,7 +23,15 @@ class Server(Connection):
         connection.pubkey = self.pubkey
         connection.privkey = self.privkey
         connection._recv_callbacks = self._recv_callbacks
+        connection._raw_callbacks = self._raw_callbacks
         connection._recv_no_protocol_callback = self._recv_no_protocol_callback
+        connection._rejected_callback = self._rejected_callback
+        connection._priorities = self._priorities
+        connection._rate_limits = self._rate_limits
+        connection._queue_limits = self._queue_limits
+        connection._dispatch_workers = self._dispatch_workers
+        connection.reject_interval = self.reject_interval
+        connection.capture = self.capture
         self._clients.append(connection)
         self._new_connection_callback(connection)
         connection.listen()
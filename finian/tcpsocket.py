@@ -119,7 +119,10 @@ class TCPSocket:
     def _recv(self, size: int) -> bytes:
         buf = b''
         while len(buf) != size:
-            buf += self.socket.recv(size - len(buf))
+            chunk = self.socket.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionResetError("Connection broke")
+            buf += chunk
         return buf
 
     def recv(self) -> Optional[Result]:
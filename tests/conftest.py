@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import socket
+import threading
+import time
+
+import pytest
+
+from finian import Client, Server, admission
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class Loopback:
+    def __init__(self):
+        # port 0 lets the OS pick a free port
+        self.server = Server("127.0.0.1", 0)
+        self.port: int = self.server.socket.socket.getsockname()[1]
+        # listen before the accept loop starts so that connecting cannot
+        # race it, Server.listen calling listen again is harmless
+        self.server.socket.listen()
+        self._started: bool = False
+        self._clients = []
+
+    def start(self):
+        if not self._started:
+            thread = threading.Thread(target=self.server.listen)
+            thread.daemon = True
+            thread.start()
+            self._started = True
+
+    def connect(self) -> Client:
+        """Connects a listening client, reject frames it receives are
+        collected in `client.session["rejected"]`.
+        """
+        self.start()
+        client = Client("127.0.0.1", self.port)
+        assert client.connect()
+        rejected = client.session["rejected"] = []
+        client.rejected(lambda c, r: rejected.append(r.data))
+        thread = threading.Thread(target=client.listen)
+        thread.daemon = True
+        thread.start()
+        self._clients.append((client, thread))
+        return client
+
+    def close(self):
+        for client, thread in self._clients:
+            try:
+                client.socket.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            thread.join(1)
+            client.socket.socket.close()
+
+
+def _wait_for(predicate, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def loopback():
+    loopback = Loopback()
+    yield loopback
+    loopback.close()
+
+
+@pytest.fixture
+def wait_for():
+    return _wait_for
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import threading
+
+from finian.admission import DispatchQueues, TokenBucket
+
+
+def test_bucket_allows_burst_then_refuses(clock):
+    bucket = TokenBucket(rate=1, burst=3)
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+
+def test_bucket_refills_at_rate(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+    assert bucket.consume() and bucket.consume()
+    assert not bucket.consume()
+    clock.now += 0.5
+    assert bucket.consume()
+    assert not bucket.consume()
+
+
+def test_bucket_refill_is_capped_at_burst(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    clock.now += 60
+    assert [bucket.consume() for _ in range(3)] == [True, True, False]
+
+
+def test_bucket_peek_does_not_consume(clock):
+    bucket = TokenBucket(rate=1, burst=1)
+    assert bucket.peek()
+    assert bucket.peek()
+    assert bucket.consume()
+    assert not bucket.peek()
+
+
+def test_queues_are_fifo_per_priority():
+    queues = DispatchQueues({})
+    for item in ("a", "b", "c"):
+        assert queues.put(0, item)
+    assert [queues.get(0) for _ in range(3)] == ["a", "b", "c"]
+
+
+def test_queues_keep_priorities_apart():
+    queues = DispatchQueues({})
+    queues.put(0, "bulk-1")
+    queues.put(0, "bulk-2")
+    queues.put(10, "control")
+    # a backlog at one priority does not hold up another
+    assert queues.get(10) == "control"
+    assert queues.qsize(0) == 2
+    assert queues.qsize(10) == 0
+
+
+def test_queues_enforce_per_priority_limit():
+    queues = DispatchQueues({0: 1, 10: 2})
+    assert queues.put(0, "a")
+    assert not queues.put(0, "b")
+    assert queues.put(10, "c")
+    assert queues.put(10, "d")
+    assert not queues.put(10, "e")
+    queues.get(0)
+    assert queues.put(0, "f")
+
+
+def test_queues_default_limit_applies_to_unlisted_priorities():
+    queues = DispatchQueues({None: 1, 10: 0})
+    assert queues.put(5, "a")
+    assert not queues.put(5, "b")
+    # 0 means unbounded, even with a default limit set
+    assert all(queues.put(10, i) for i in range(100))
+
+
+def test_queues_unbounded_without_limits():
+    queues = DispatchQueues({})
+    assert all(queues.put(0, i) for i in range(100))
+
+
+def test_queues_get_blocks_until_put():
+    queues = DispatchQueues({})
+    got = []
+    thread = threading.Thread(target=lambda: got.append(queues.get(3)))
+    thread.start()
+    queues.put(1, "other")
+    queues.put(3, "mine")
+    thread.join(1)
+    assert got == ["mine"]
+
+
+def test_queues_close_wakes_getters():
+    queues = DispatchQueues({})
+    got = []
+    thread = threading.Thread(target=lambda: got.append(queues.get(0)))
+    thread.start()
+    queues.close()
+    thread.join(1)
+    assert got == [None]
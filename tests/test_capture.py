@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from finian import loadgen
+from finian.capture import CaptureReader, CaptureWriter, RECV, SEND
+from finian.connection import REJECT_PROTOCOL
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "test.fcap")
+
+
+def test_round_trip(path):
+    with CaptureWriter(path) as writer:
+        first = writer.new_conn_id()
+        second = writer.new_conn_id()
+        writer.record(first, SEND, True, 5, b'{"a": 1}')
+        writer.record(second, RECV, False, 6, None)
+    with CaptureReader(path) as reader:
+        frames = list(reader)
+    assert [(f.conn_id, f.direction, f.json, f.protocol, f.data)
+            for f in frames] == [
+        (first, SEND, True, 5, b'{"a": 1}'),
+        (second, RECV, False, 6, b""),
+    ]
+    assert first != second
+    assert frames[0].offset <= frames[1].offset
+
+
+def test_truncated_frame_is_skipped(path):
+    with CaptureWriter(path) as writer:
+        writer.record(0, SEND, False, 5, b"complete")
+        writer.record(0, SEND, False, 5, b"cut short")
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 3)
+    with CaptureReader(path) as reader:
+        assert [f.data for f in reader] == [b"complete"]
+
+
+@pytest.mark.parametrize("content", [b"", b"FNC", b"nonsense" * 4])
+def test_not_a_capture_file(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+    with pytest.raises(ValueError, match="not a finian capture file"):
+        CaptureReader(path)
+
+
+def test_record_after_close_is_ignored(path):
+    writer = CaptureWriter(path)
+    writer.record(0, SEND, False, 5, b"kept")
+    writer.close()
+    writer.record(0, SEND, False, 5, b"dropped")
+    writer.flush()
+    with CaptureReader(path) as reader:
+        assert [f.data for f in reader] == [b"kept"]
+
+
+def test_writer_flushes_after_interval(path):
+    writer = CaptureWriter(path, flush_interval=0)
+    writer.record(0, SEND, False, 5, b"x")
+    with CaptureReader(path) as reader:
+        assert len(list(reader)) == 1
+    writer.close()
+
+
+def test_load_frames_splits_connections_and_skips_control(path):
+    with CaptureWriter(path) as writer:
+        for conn_id, protocol in ((1, 5), (0, 1), (0, 5), (1, 2),
+                                  (0, REJECT_PROTOCOL), (1, 6)):
+            writer.record(conn_id, SEND, False, protocol, b"x")
+        writer.record(0, RECV, False, 7, b"x")
+    conns = loadgen.load_frames(path, SEND)
+    assert [[f.protocol for f in frames] for frames in conns] == \
+        [[5], [5, 6]]
+    assert [[f.protocol for f in frames]
+            for frames in loadgen.load_frames(path, RECV)] == [[7]]
+
+
+def test_percentile():
+    values = [float(i) for i in range(101)]
+    assert loadgen.percentile(values, 50) == 50.0
+    assert loadgen.percentile(values, 99) == 99.0
+    assert loadgen.percentile([], 99) == 0.0
+
+
+def test_info_cli(path, capsys):
+    with CaptureWriter(path) as writer:
+        writer.record(0, SEND, False, 5, b"abc")
+        writer.record(1, SEND, False, 6, b"de")
+    loadgen.main(["info", path])
+    out = capsys.readouterr().out
+    assert "connections: 2" in out
+    assert "frames: 2" in out
+    assert "bytes: 5" in out
+
+
+def test_info_cli_rejects_bad_file(path, capsys):
+    open(path, "wb").close()
+    with pytest.raises(SystemExit):
+        loadgen.main(["info", path])
+    assert "not a finian capture file" in capsys.readouterr().err
+
+
+def test_server_capture_keeps_connections_apart(path, loopback, wait_for):
+    loopback.server.capture = CaptureWriter(path)
+    got = []
+    loopback.server.protocol(5, False)(lambda c, r: got.append(r.data))
+    first = loopback.connect()
+    second = loopback.connect()
+    first.send(b"a", 5)
+    second.send(b"b", 5)
+    second.send(b"c", 5)
+    assert wait_for(lambda: len(got) == 3)
+    loopback.server.capture.close()
+    conns = loadgen.load_frames(path, RECV)
+    assert sorted([f.data for f in frames] for frames in conns) == \
+        [[b"a"], [b"b", b"c"]]
+
+
+def _echo_capture(path, frames):
+    with CaptureWriter(path) as writer:
+        for conn_id in range(2):
+            for i in range(frames):
+                writer.record(conn_id, SEND, True, 5, b'{"i": %d}' % i)
+
+
+def test_replay_counts(path, loopback):
+    loopback.server.protocol(5, False)(lambda c, r: c.send(r.data, 6))
+    _echo_capture(path, 10)
+    loopback.start()
+    report = loadgen.replay("127.0.0.1", loopback.port, path, speed=100,
+                            processes=2, replies=True)
+    assert report["clients"] == 2
+    assert report["failed"] == 0
+    assert report["sent"] == 20
+    assert report["received"] == 20
+    assert report["rejected"] == 0
+
+
+def test_replay_with_key_exchange(path, loopback):
+    key = rsa.generate_private_key(
+        public_exponent=65537, key_size=2048, backend=default_backend()
+    )
+    loopback.server.privkey = key
+    loopback.server.pubkey = key.public_key()
+    decrypted = []
+
+    @loopback.server.protocol(5, False)
+    def echo(conn, result):
+        # the client key is in place and the frame was decrypted back
+        # into JSON
+        decrypted.append(
+            conn.recp_pubkey is not None and isinstance(result.data, dict)
+        )
+        conn.send(result.data, 6)
+
+    _echo_capture(path, 3)
+    loopback.start()
+    report = loadgen.replay("127.0.0.1", loopback.port, path, speed=100,
+                            replies=True, key_exchange=True)
+    assert report["failed"] == 0
+    assert report["received"] == 6
+    assert decrypted == [True] * 6
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import functools
+import threading
+import time
+
+from finian.connection import Connection, REJECT_PROTOCOL
+
+
+def test_admit_charges_no_bucket_unless_every_limit_admits(clock):
+    conn = Connection()
+    conn.rate_limit(1, 5)
+    conn.rate_limit(1, 1, protocol=7)
+    assert [conn._admit(7) for _ in range(5)] == \
+        [True, False, False, False, False]
+    # the four refused protocol 7 frames left the connection budget alone
+    assert [conn._admit(8) for _ in range(5)] == \
+        [True, True, True, True, False]
+
+
+def test_only_first_handshake_frame_skips_rate_limits(loopback, wait_for):
+    loopback.server.rate_limit(0, 1)
+    client = loopback.connect()
+    replies = []
+    client.protocol(2, False)(lambda c, r: replies.append(r))
+    for _ in range(3):
+        client.request_recv_pubkey()
+    # the first request is free, the second takes the only token
+    assert wait_for(lambda: client.session["rejected"])
+    time.sleep(0.1)
+    assert len(replies) == 2
+    assert client.session["rejected"] == [
+        {"protocol": 1, "reason": "rate_limited", "dropped": 1}
+    ]
+
+
+def test_rate_limited_rejects_are_coalesced(loopback, wait_for):
+    loopback.server.rate_limit(0, 1)
+    loopback.server.reject_interval = 0.2
+    loopback.server.protocol(5, False)(lambda c, r: None)
+    client = loopback.connect()
+    for _ in range(10):
+        client.send(b"x", 5)
+    rejected = client.session["rejected"]
+    # the first drop is reported at once, the rest once the interval is up
+    assert wait_for(lambda: len(rejected) == 2)
+    assert rejected == [
+        {"protocol": 5, "reason": "rate_limited", "dropped": 1},
+        {"protocol": 5, "reason": "rate_limited", "dropped": 8},
+    ]
+    assert loopback.server.clients[0].reject_interval == 0.2
+
+
+def test_incoming_reject_frames_are_rate_limited(loopback, wait_for):
+    loopback.server.rate_limit(0, 1)
+    seen = []
+    loopback.server.rejected(lambda c, r: seen.append(r.data))
+    client = loopback.connect()
+    for i in range(3):
+        client.send({"protocol": 5, "reason": "x", "dropped": i},
+                    REJECT_PROTOCOL)
+    assert wait_for(lambda: seen)
+    time.sleep(0.1)
+    assert len(seen) == 1
+    # reject frames over the limit are not answered with reject frames
+    assert client.session["rejected"] == []
+
+
+def test_protocols_are_routed_to_their_priority(loopback, wait_for):
+    release = threading.Event()
+    handled = []
+
+    @loopback.server.protocol(5, False)
+    def bulk(conn, result):
+        release.wait(2)
+        handled.append(5)
+
+    @loopback.server.protocol(7, False, priority=10)
+    def control(conn, result):
+        handled.append(7)
+
+    loopback.server.queue_limit(0)
+    client = loopback.connect()
+    client.send(b"x", 5)
+    client.send(b"x", 7)
+    # the control frame is not held up behind the blocked bulk handler
+    assert wait_for(lambda: handled == [7])
+    release.set()
+    assert wait_for(lambda: handled == [7, 5])
+
+
+def test_dispatch_workers_bound_handler_concurrency(loopback, wait_for):
+    release = threading.Event()
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    @loopback.server.protocol(5)
+    def bulk(conn, result):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        release.wait(2)
+        with lock:
+            running[0] -= 1
+
+    loopback.server.dispatch_workers(2)
+    client = loopback.connect()
+    for _ in range(6):
+        client.send(b"x", 5)
+    assert wait_for(lambda: running[0] == 2)
+    time.sleep(0.1)
+    assert peak[0] == 2
+    release.set()
+    assert wait_for(lambda: running[0] == 0)
+
+
+def test_full_queue_rejects_as_overloaded(loopback, wait_for):
+    release = threading.Event()
+    started = threading.Event()
+
+    @loopback.server.protocol(5)
+    def bulk(conn, result):
+        started.set()
+        release.wait(2)
+
+    loopback.server.queue_limit(1)
+    client = loopback.connect()
+    client.send(b"x", 5)
+    assert started.wait(2)
+    # one frame waits in the queue, the next one does not fit
+    client.send(b"x", 5)
+    client.send(b"x", 5)
+    assert wait_for(lambda: client.session["rejected"])
+    release.set()
+    assert client.session["rejected"] == [
+        {"protocol": 5, "reason": "overloaded", "dropped": 1}
+    ]
+
+
+def test_queued_handlers_keep_user_decorators(loopback, wait_for):
+    calls = []
+
+    def guard(f):
+        @functools.wraps(f)
+        def wrapper(conn, result):
+            calls.append("guard")
+            return f(conn, result)
+
+        return wrapper
+
+    @loopback.server.protocol(5, False)
+    @guard
+    def handler(conn, result):
+        calls.append("handler")
+
+    loopback.server.queue_limit(10)
+    client = loopback.connect()
+    client.send(b"x", 5)
+    assert wait_for(lambda: calls == ["guard", "handler"])